@@ -4,12 +4,12 @@ sys.path.append("..")
 import argparse
 import logging
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from time import strftime
 import pandas as pd
 import torch
 
-from sklearn.metrics import mean_squared_error
 from torchlaplace.dataset import generate_data_set
 
 from torchlaplace.model import GeneralHNL
@@ -20,6 +20,11 @@ datasets = ["sine", "nrel", "mfred"]
 file_name = Path(__file__).stem
 
 
+def save_results(path, saved_dict):
+    with open(path, "wb") as f:
+        pickle.dump(saved_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
 def experiment_with_all_baselines(
         dataset, double, batch_size, extrapolate, epochs, seed, run_times,
         learning_rate, weight_decay, trajectories_to_sample,
@@ -33,6 +38,9 @@ def experiment_with_all_baselines(
 
 
     df_list_baseline_results = []
+    # pickle results in the background while the next seed trains
+    saver = ThreadPoolExecutor(max_workers=1)
+    pending_saves = []
 
     for seed in range(seed, seed + run_times):
         setup_seed(seed)
@@ -61,7 +69,8 @@ def experiment_with_all_baselines(
              solete_resolution=solete_resolution,
              transformed=transformed,
              avg_terms=1,
-             window_width=window_width)
+             window_width=window_width,
+             preload=True)
         logger.info(f"input steps:\t {input_timesteps}")
         logger.info(f"output steps:\t {output_timesteps}")
         if avg_terms_list is not None:
@@ -136,10 +145,6 @@ def experiment_with_all_baselines(
             "window_width": window_width
         }
 
-        # Pre-save
-        with open(path, "wb") as f:
-            pickle.dump(saved_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
-
         model_name, system = "Hierarchical NL", GeneralHNL(
             input_dim=input_dim,
             output_dim=output_dim,
@@ -188,9 +193,9 @@ def experiment_with_all_baselines(
             test_preds, test_trajs = system.predict(dltest)
 
             assert test_trajs.shape == test_preds[-1].shape
-            test_rmse = mean_squared_error(
-                test_trajs.detach().cpu().numpy().flatten(),
-                test_preds[-1].detach().cpu().numpy().flatten())
+            with torch.no_grad():
+                test_rmse = torch.mean(
+                    (test_trajs - test_preds[-1])**2).item()
             logger.info(f"Result: {model_name} - TEST RMSE: {test_rmse}")
             df_list_baseline_results.append({
                 'method': model_name,
@@ -206,16 +211,16 @@ def experiment_with_all_baselines(
                 "test_preds": test_preds,
                 "test_trajs": test_trajs.detach().cpu().numpy(),
             }
-            # Checkpoint
-            with open(path, "wb") as f:
-                pickle.dump(saved_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
         except Exception as e:
             logger.error(e)
             logger.error(f"Error for model: {model_name}")
             raise e
         path = f"./results/{dataset}/{path_run_name}-{seed}.pkl"
-        with open(path, "wb") as f:
-            pickle.dump(saved_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pending_saves.append(saver.submit(save_results, path, saved_dict))
+
+    for future in pending_saves:
+        future.result()
+    saver.shutdown()
 
     # Process results for experiment
     df_results = pd.DataFrame(df_list_baseline_results)
@@ -3,13 +3,14 @@ sys.path.append("..")
 
 import argparse
 import logging
+import logging.handlers
 import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from time import strftime
 import pandas as pd
 import torch
 
-from sklearn.metrics import mean_squared_error
 from torchlaplace.dataset import generate_data_set
 
 from torchlaplace.model import GeneralNeuralLaplace
@@ -20,18 +21,45 @@ datasets = ["sine", "nrel", "mfred"]
 
 file_name = Path(__file__).stem
 
+logger = logging.getLogger()
 
-def experiment_with_all_baselines(
+
+def save_results(path, saved_dict):
+    with open(path, "wb") as f:
+        pickle.dump(saved_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def seed_device(device, rank):
+    # spread parallel seed runs round-robin over the visible GPUs, starting
+    # from the one that was asked for
+    if device.type == "cuda":
+        index = ((device.index or 0) + rank) % torch.cuda.device_count()
+        return torch.device(f"cuda:{index}")
+    return device
+
+
+def init_worker_logging(queue):
+    # spawned workers import this file as __mp_main__ and skip the logging
+    # setup below, so their records are forwarded to the parent's handlers
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(queue)]
+    root.setLevel(logging.INFO)
+
+
+def run_baselines(
         dataset, double, batch_size, extrapolate, epochs, seed, run_times,
         learning_rate, weight_decay, trajectories_to_sample,
         time_points_to_sample, observe_stride, predict_stride, observe_steps,
         noise_std, normalize_dataset, encode_obs_time, latent_dim,
         hidden_units, avg_terms_list, patience, device,
         use_sphere_projection, ilt_algorithm, solete_energy, solete_resolution,
-        transformed, window_width, add_external_feature, persistence):
-    # Compares against all baselines, 
-
+        transformed, window_width, add_external_feature, persistence,
+        path_run_name):
     df_list_baseline_results = []
+    # results are pickled in the background so the next model starts training
+    # right away; a single worker keeps the writes in submission order
+    saver = ThreadPoolExecutor(max_workers=1)
+    pending_saves = []
 
     for seed in range(seed, seed + run_times):
         setup_seed(seed)
@@ -62,7 +90,8 @@ def experiment_with_all_baselines(
                  transformed=transformed,
                  add_external_feature=add_external_feature,
                  window_width=window_width,
-                 avg_terms=avg_terms)
+                 avg_terms=avg_terms,
+                 preload=True)
             logger.info(f"input steps:\t {input_timesteps}")
             logger.info(f"output steps:\t {output_timesteps}")
             desired_f = sample_rate / avg_terms
@@ -86,10 +115,6 @@ def experiment_with_all_baselines(
 
             saved_dict[f"avg_terms_{avg_terms}"] = sub_saved_dict
 
-            # Pre-save
-            with open(path, "wb") as f:
-                pickle.dump(saved_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
-
             models = [
                 (
                     "Neural Laplace",
@@ -202,10 +227,10 @@ def experiment_with_all_baselines(
                     test_preds, test_trajs = system.predict(dltest)
                     print(test_preds.shape)
                     print(test_trajs.shape)
-                    test_rmse = mean_squared_error(
-                        test_trajs[:, -test_preds.shape[1]:, :].detach().cpu().
-                        numpy().flatten(),
-                        test_preds.detach().cpu().numpy().flatten())
+                    with torch.no_grad():
+                        test_rmse = torch.mean(
+                            (test_trajs[:, -test_preds.shape[1]:, :] -
+                             test_preds)**2).item()
                     logger.info(
                         f"Result: {model_name} - TEST RMSE: {test_rmse}")
                     df_list_baseline_results.append({
@@ -224,12 +249,6 @@ def experiment_with_all_baselines(
                         "test_preds": test_preds.detach().cpu().numpy(),
                         "test_trajs": test_trajs.detach().cpu().numpy(),
                     }
-                    # Checkpoint
-                    saved_dict[f"avg_terms_{avg_terms}"] = sub_saved_dict
-                    with open(path, "wb") as f:
-                        pickle.dump(saved_dict,
-                                    f,
-                                    protocol=pickle.HIGHEST_PROTOCOL)
                 except Exception as e:
                     pass
                     logger.error(e)
@@ -237,8 +256,59 @@ def experiment_with_all_baselines(
                     raise e
             path = f"./results/{dataset}/{path_run_name}-{seed}.pkl"
             saved_dict[f"avg_terms_{avg_terms}"] = sub_saved_dict
-            with open(path, "wb") as f:
-                pickle.dump(saved_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+            # shallow copy: later resolutions add keys while this is pickled
+            pending_saves.append(
+                saver.submit(save_results, path, dict(saved_dict)))
+
+    for future in pending_saves:
+        future.result()
+    saver.shutdown()
+    return df_list_baseline_results
+
+
+def experiment_with_all_baselines(seed,
+                                  run_times,
+                                  device,
+                                  parallel_seeds=False,
+                                  **kwargs):
+    # Compares against all baselines, 
+    max_workers = run_times
+    if parallel_seeds and device.type == "cuda":
+        # at most one run per GPU at a time; a single GPU runs them serially
+        max_workers = min(run_times, torch.cuda.device_count())
+        if max_workers < 2:
+            logger.info("Only one GPU visible, running seeds serially")
+            parallel_seeds = False
+    if parallel_seeds:
+        # seeds are independent runs, so each one gets its own process
+        ctx = torch.multiprocessing.get_context("spawn")
+        log_queue = ctx.Queue()
+        listener = logging.handlers.QueueListener(log_queue,
+                                                  *logger.handlers)
+        listener.start()
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers,
+                                     mp_context=ctx,
+                                     initializer=init_worker_logging,
+                                     initargs=(log_queue, )) as pool:
+                futures = [
+                    pool.submit(run_baselines,
+                                seed=s,
+                                run_times=1,
+                                device=seed_device(device, rank),
+                                **kwargs)
+                    for rank, s in enumerate(range(seed, seed + run_times))
+                ]
+                df_list_baseline_results = [
+                    result for future in futures for result in future.result()
+                ]
+        finally:
+            listener.stop()
+    else:
+        df_list_baseline_results = run_baselines(seed=seed,
+                                                 run_times=run_times,
+                                                 device=device,
+                                                 **kwargs)
 
     # Process results for experiment
     df_results = pd.DataFrame(df_list_baseline_results)
@@ -295,6 +365,8 @@ if __name__ == "__main__":
 
     parser.add_argument('--persistence', type=str, default="naive")
     parser.add_argument('--avg_terms_list', nargs='+', type=int, default=None)
+    parser.add_argument('--parallel_seeds',
+                        action="store_true")  # Default False
     args = parser.parse_args()
 
     assert args.dataset in datasets
@@ -346,4 +418,6 @@ if __name__ == "__main__":
         transformed=args.transformed,
         add_external_feature=args.add_external_feature,
         persistence=args.persistence,
-        window_width=args.window_width)
+        window_width=args.window_width,
+        path_run_name=path_run_name,
+        parallel_seeds=args.parallel_seeds)
@@ -4,22 +4,67 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 import numpy as np
+from .utils import collect_predictions
 
 logger = logging.getLogger()
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
 
+def batch_to_device(batch, device):
+    for k in batch:
+        if isinstance(batch[k], torch.Tensor):
+            batch[k] = batch[k].to(device, non_blocking=True)
+    return batch
+
+
+def prefetch_batches(dl, device):
+    # copy batch k+1 on a side stream while the default stream runs batch k;
+    # batches already on the device make the copies no-ops
+    device = torch.device(device)
+    if device.type != "cuda":
+        for batch in dl:
+            yield batch_to_device(batch, device)
+        return
+    side = torch.cuda.Stream(device)
+    current = torch.cuda.current_stream(device)
+
+    def load(batch):
+        with torch.cuda.stream(side):
+            return batch_to_device(batch, device)
+
+    loader_iter = iter(dl)
+    try:
+        next_batch = load(next(loader_iter))
+    except StopIteration:
+        return
+    while next_batch is not None:
+        current.wait_stream(side)
+        batch = next_batch
+        for v in batch.values():
+            # memory allocated on the side stream is used on this one
+            if isinstance(v, torch.Tensor):
+                v.record_stream(current)
+        next_batch = next(loader_iter, None)
+        if next_batch is not None:
+            next_batch = load(next_batch)
+        yield batch
+
+
 class GRUEncoder(nn.Module):
 
     def __init__(self, dimension, hidden_units):
         super(GRUEncoder, self).__init__()
-        self.gru = nn.GRU(dimension, hidden_units, 2, batch_first=True)
+        # two single-layer GRUs, equivalent to one 2-layer GRU without dropout
+        self.gru1 = nn.GRU(dimension, hidden_units, 1, batch_first=False)
+        self.gru2 = nn.GRU(hidden_units, hidden_units, 1, batch_first=False)
         self.linear_out = nn.Linear(hidden_units, dimension)
 
     def forward(self, i):
-        out, _ = self.gru(i)
-        return self.linear_out(out[:, -1, :])
+        i = i.transpose(0, 1).contiguous()
+        h1, _ = self.gru1(i)
+        _, h_n = self.gru2(h1)
+        return self.linear_out(h_n[0])
 
 
 class LSTMNetwork(nn.Module):
@@ -31,7 +76,7 @@ class LSTMNetwork(nn.Module):
         _, avail_fcst_tsteps = in_timesteps
         self.avail_fcst = False if avail_fcst_dim_in is None else True
 
-        self.lstm = nn.LSTM(hist_dim_in, hidden_units, 2, batch_first=True)
+        self.lstm = nn.LSTM(hist_dim_in, hidden_units, 2, batch_first=False)
 
         concat_dim = hidden_units
         if avail_fcst_dim_in is not None:
@@ -43,13 +88,15 @@ class LSTMNetwork(nn.Module):
         self.out_dim = out_dim
 
     def forward(self, observed_data, available_forecasts):
-        out, _ = self.lstm(observed_data)
+        # (T, B, D) layout is what cuDNN runs natively; h_n[-1] is the last
+        # layer's final hidden state, i.e. out[:, -1, :] in batch-first terms
+        _, (h_n, _) = self.lstm(observed_data.transpose(0, 1).contiguous())
 
         if self.avail_fcst:
-            out = torch.concat((out[:, -1, :], available_forecasts.flatten(1)),
+            out = torch.concat((h_n[-1], available_forecasts.flatten(1)),
                                axis=-1)
         else:
-            out = out[:, -1, :]
+            out = h_n[-1]
         out = self.linear_out(out).reshape(-1, self.out_timesteps,
                                            self.out_dim)
 
@@ -98,10 +145,13 @@ class Persistence(nn.Module):
 
     def forward(self, i):
         if self.kind == "naive":
-            out = i[:, [-1], :].repeat(1, self.out_timesteps, 1)
+            # select features on the last step only, then broadcast it over
+            # the horizon as a stride-0 view instead of materialising copies
+            out = i[:, -1:, self.out_feature].expand(-1, self.out_timesteps,
+                                                     -1)
         elif self.kind == "loop":
-            out = i[:, -self.out_timesteps:, :]
-        return out[..., self.out_feature]
+            out = i[:, -self.out_timesteps:, self.out_feature]
+        return out
 
 
 
@@ -114,8 +164,10 @@ class GeneralPersistence(nn.Module):
         out_timesteps,
         out_feature,
         method="naive",
+        device='cpu'
     ):
         super(GeneralPersistence, self).__init__()
+        self.device = device
         if method == "naive":
             self.model = Persistence(out_timesteps=out_timesteps,
                                      out_feature=out_feature,
@@ -128,15 +180,17 @@ class GeneralPersistence(nn.Module):
             raise ValueError("No such Persistence model.")
         self.loss_fn = torch.nn.MSELoss()
 
+    @torch.no_grad()
     def _get_loss(self, dl):
         cum_loss = 0
-        cum_batches = 0
-        for batch in dl:
+        cum_numel = 0
+        for batch in prefetch_batches(dl, self.device):
             preds = self.model(batch["observed_data"])
-            cum_loss += self.loss_fn(torch.flatten(preds),
-                                     torch.flatten(batch["data_to_predict"]))
-            cum_batches += 1
-        mse = cum_loss / cum_batches
+            cum_loss += F.mse_loss(preds,
+                                   batch["data_to_predict"],
+                                   reduction="sum")
+            cum_numel += preds.numel()
+        mse = cum_loss / cum_numel
         return mse
 
     def training_step(self, batch):
@@ -154,13 +208,12 @@ class GeneralPersistence(nn.Module):
         mse = self._get_loss(dltest)
         return mse, mse
 
+    @torch.no_grad()
     def predict(self, dl):
         self.model.eval()
-        predictions, trajs = [], []
-        for batch in dl:
-            predictions.append(self.model(batch["observed_data"]))
-            trajs.append(batch["data_to_predict"])
-        return torch.cat(predictions, 0), torch.cat(trajs, 0)
+        return collect_predictions(
+            ((self.model(batch["observed_data"]), batch["data_to_predict"])
+             for batch in prefetch_batches(dl, self.device)), len(dl.dataset))
 
 
 
@@ -202,19 +255,18 @@ class GeneralNeuralNetwork(nn.Module):
             raise ValueError("No such NN model.")
         self.loss_fn = torch.nn.MSELoss()
 
+    @torch.no_grad()
     def _get_loss(self, dl):
         cum_loss = 0
-        cum_batches = 0
-        for batch in dl:
-            for k in batch:
-                if isinstance(batch[k], torch.Tensor):
-                    batch[k] = batch[k].to(self.device)
+        cum_numel = 0
+        for batch in prefetch_batches(dl, self.device):
             preds = self.model(batch["observed_data"],
                                batch["available_forecasts"])
-            cum_loss += self.loss_fn(torch.flatten(preds),
-                                     torch.flatten(batch["data_to_predict"]))
-            cum_batches += 1
-        mse = cum_loss / cum_batches
+            cum_loss += F.mse_loss(preds,
+                                   batch["data_to_predict"],
+                                   reduction="sum")
+            cum_numel += preds.numel()
+        mse = cum_loss / cum_numel
         return mse
 
     def training_step(self, batch):
@@ -233,18 +285,14 @@ class GeneralNeuralNetwork(nn.Module):
         mse = self._get_loss(dltest)
         return mse, mse
 
+    @torch.no_grad()
     def predict(self, dl):
         self.model.eval()
-        predictions, trajs = [], []
-        for batch in dl:
-            for k in batch:
-                if isinstance(batch[k], torch.Tensor):
-                    batch[k] = batch[k].to(self.device)
-            predictions.append(
-                self.model(batch["observed_data"],
-                           batch["available_forecasts"]))
-            trajs.append(batch["data_to_predict"])
-        return torch.cat(predictions, 0), torch.cat(trajs, 0)
+        return collect_predictions(
+            ((self.model(batch["observed_data"],
+                         batch["available_forecasts"]),
+              batch["data_to_predict"])
+             for batch in prefetch_batches(dl, self.device)), len(dl.dataset))
 
 
 
@@ -1,6 +1,12 @@
+import copy
+import hashlib
+import os
+from functools import partial
+
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import (BatchSampler, DataLoader, Dataset,
+                              SequentialSampler)
 import pandas as pd
 from .utils import setup_seed
 
@@ -9,10 +15,18 @@ from pathlib import Path
 local_path = Path(__file__).parent
 
 
+def _aggregate(x, avg_terms):
+    # non-overlapping mean over dim 1, i.e. avg_pool1d(x, k, k) without the
+    # transposes; a trailing partial window is dropped the same way
+    steps = x.shape[1] // avg_terms
+    return x[:, :steps * avg_terms].unflatten(1, (steps, avg_terms)).mean(2)
+
+
 class TimeSeriesDataset(Dataset):
 
     def __init__(self, trajs, time_steps, observe_steps, avg_terms,
-                 hist_feature, fcst_feature, avail_fcst_feature):
+                 hist_feature, fcst_feature, avail_fcst_feature,
+                 avail_fcst_stride=1):
         if len(time_steps.shape) < 2:
             time_steps = time_steps.unsqueeze(0)
 
@@ -24,78 +38,95 @@ class TimeSeriesDataset(Dataset):
 
         # aggregated if needed
         if avg_terms > 1:
-            tp_to_predict = tp_to_predict[..., None]
-            observed_tp = observed_tp[..., None]
-
-            observed_data = observed_data.transpose(1, 2)
-            observed_data = torch.nn.functional.avg_pool1d(
-                observed_data, avg_terms, avg_terms)
-            observed_data = observed_data.transpose(1, 2)
-
-            data_to_predict = data_to_predict.transpose(1, 2)
-            data_to_predict = torch.nn.functional.avg_pool1d(
-                data_to_predict, avg_terms, avg_terms)
-            data_to_predict = data_to_predict.transpose(1, 2)
-
-            tp_to_predict = tp_to_predict.transpose(1, 2)
-            tp_to_predict = torch.nn.functional.avg_pool1d(
-                tp_to_predict, avg_terms, avg_terms)
-            tp_to_predict = tp_to_predict.transpose(1,
-                                                    2).squeeze().unsqueeze(0)
-
-            observed_tp = observed_tp.transpose(1, 2)
-            observed_tp = torch.nn.functional.avg_pool1d(
-                observed_tp, avg_terms, avg_terms)
-            observed_tp = observed_tp.transpose(1, 2).squeeze().unsqueeze(0)
-
-        self.observed_data = observed_data
-        self.data_to_predict = data_to_predict
+            observed_data = _aggregate(observed_data, avg_terms)
+            data_to_predict = _aggregate(data_to_predict, avg_terms)
+            tp_to_predict = _aggregate(tp_to_predict, avg_terms)
+            observed_tp = _aggregate(observed_tp, avg_terms)
+
+        # one-time packing so batches are gathered from dense rows; a no-op
+        # when feature selection already produced a fresh tensor
+        self.observed_data = observed_data.contiguous()
+        self.data_to_predict = data_to_predict.contiguous()
         self.tp_to_predict = tp_to_predict
         self.observed_tp = observed_tp
 
         # get available forecasts if possible
         self.avail_fcst = False if avail_fcst_feature is None else True
         if self.avail_fcst:
-            self.available_forecasts = trajs[:, observe_steps:,
-                                             avail_fcst_feature]
+            # forecasts are only issued every `avail_fcst_stride` steps
+            # (unaligned resolution) and are NaN in between; windows start on
+            # an issue step, so keep the first one at or after observe_steps
+            start = observe_steps + (-observe_steps) % avail_fcst_stride
+            self.available_forecasts = trajs[:, start::avail_fcst_stride,
+                                             avail_fcst_feature].contiguous()
+            assert not torch.isnan(self.available_forecasts).any(), \
+                "available forecasts are not aligned to avail_fcst_stride"
 
     def __len__(self):
         return len(self.observed_data)
 
-    def __getitem__(self, index):
+    def to(self, device):
+        self.observed_data = self.observed_data.to(device)
+        self.data_to_predict = self.data_to_predict.to(device)
+        self.tp_to_predict = self.tp_to_predict.to(device)
+        self.observed_tp = self.observed_tp.to(device)
         if self.avail_fcst:
-            return self.observed_data[index], self.data_to_predict[
-                index], self.available_forecasts[
-                    index], self.tp_to_predict, self.observed_tp
-        else:
-            return self.observed_data[index], self.data_to_predict[
-                index], torch.tensor(
-                    torch.nan), self.tp_to_predict, self.observed_tp
-
-
-def collate_fn(data):
-    observed_data, data_to_pred, available_forecasts, tp_to_predict, observed_tp = zip(
-        *data)
-    observed_data = torch.stack(observed_data)
-    data_to_pred = torch.stack(data_to_pred)
-    available_forecasts = torch.stack(available_forecasts)
-    tp_to_predict = tp_to_predict[0]
-    observed_tp = observed_tp[0]
-
-    # filter nan in the available forecasts (unaligned resolution)
-    not_nan_idx = torch.logical_not(torch.isnan(available_forecasts))
-    available_forecasts = available_forecasts[not_nan_idx].reshape(
-        observed_data.shape[0], -1, available_forecasts.shape[-1])
-    if available_forecasts.numel() == 0:
-        available_forecasts = None
+            self.available_forecasts = self.available_forecasts.to(device)
+        return self
+
+    def subset(self, start, stop):
+        # rows [start, stop) as views sharing this dataset's tensors
+        subset = copy.copy(self)
+        subset.observed_data = self.observed_data[start:stop]
+        subset.data_to_predict = self.data_to_predict[start:stop]
+        if self.avail_fcst:
+            subset.available_forecasts = self.available_forecasts[start:stop]
+        return subset
+
+    def __getitem__(self, index):
+        # a list of indices comes from the batch sampler in `make_dataloader`
+        if isinstance(index, list):
+            return self.__getitems__(index)
+        return (self.observed_data[index], self.data_to_predict[index],
+                self.available_forecasts[index] if self.avail_fcst else None)
+
+    def __getitems__(self, indices):
+        # one advanced-indexing gather per tensor for the whole batch
+        idx = torch.as_tensor(indices, device=self.observed_data.device)
+        return (self.observed_data[idx], self.data_to_predict[idx],
+                self.available_forecasts[idx] if self.avail_fcst else None)
+
+
+def _stack(tensors):
+    out = tensors[0].new_empty((len(tensors), ) + tensors[0].shape)
+    return torch.stack(tensors, out=out)
+
+
+def collate_fn(data, dataset, dtype=None):
+    if isinstance(data, tuple):
+        # already batched by `TimeSeriesDataset.__getitems__`
+        observed_data, data_to_pred, available_forecasts = data
+    else:
+        observed_data = _stack([d[0] for d in data])
+        data_to_pred = _stack([d[1] for d in data])
+        available_forecasts = [d[2] for d in data]
+        available_forecasts = (_stack(available_forecasts)
+                               if available_forecasts[0] is not None else None)
+
+    # low-precision storage is upcast to the model's dtype per batch
+    if dtype is not None:
+        observed_data = observed_data.to(dtype)
+        data_to_pred = data_to_pred.to(dtype)
+        if available_forecasts is not None:
+            available_forecasts = available_forecasts.to(dtype)
 
     # observe_steps = observed_data.shape[1]
     data_dict = {
         "observed_data": observed_data,
         "data_to_predict": data_to_pred,
         "available_forecasts": available_forecasts,
-        "observed_tp": observed_tp,
-        "tp_to_predict": tp_to_predict,
+        "observed_tp": dataset.observed_tp,
+        "tp_to_predict": dataset.tp_to_predict,
         "observed_mask": None,
         "mask_predicted_data": None,
         "labels": None,
@@ -104,23 +135,98 @@ def collate_fn(data):
     return data_dict
 
 
+def _pinned_loader_kwargs(num_workers):
+    loader_kwargs = {"pin_memory": True}
+    if num_workers > 0:
+        loader_kwargs.update(num_workers=num_workers,
+                             persistent_workers=True,
+                             prefetch_factor=2)
+    return loader_kwargs
+
+
+def default_loader_kwargs(device):
+    # (train, eval) loader kwargs. Pinned host batches and background workers
+    # only pay off when every batch is copied to a GPU; the three loaders
+    # share cpu_count()//2 workers, with at most one each for val and test
+    if torch.device(device).type != "cuda":
+        return {}, {}
+    budget = (os.cpu_count() or 0) // 2
+    eval_workers = 1 if budget >= 4 else 0
+    return (_pinned_loader_kwargs(budget - 2 * eval_workers),
+            _pinned_loader_kwargs(eval_workers))
+
+
+def make_dataloader(dataset, batch_size, dtype=None, **loader_kwargs):
+    # hand whole index batches to the dataset instead of fetching and
+    # stacking sample by sample; torch<2.0 never calls `__getitems__`, so the
+    # batch sampler with `batch_size=None` routes them through `__getitem__`
+    sampler = BatchSampler(SequentialSampler(dataset),
+                           batch_size,
+                           drop_last=False)
+    return DataLoader(dataset,
+                      sampler=sampler,
+                      batch_size=None,
+                      collate_fn=partial(collate_fn,
+                                         dataset=dataset,
+                                         dtype=dtype),
+                      **loader_kwargs)
+
+
+def load_trajs(csv_path,
+               window_width,
+               double=False,
+               window_stride=12,
+               storage_dtype=None):
+    # the parsed csv is saved once and memory-mapped (copy-on-write) on later
+    # runs; windows are an overlapping strided view over it, so only the raw
+    # (T, C) series is ever stored. The cache sits next to the csv unless
+    # TORCHLAPLACE_CACHE_DIR is set
+    csv_path = Path(csv_path).resolve()
+    cache_dir = Path(
+        os.environ.get("TORCHLAPLACE_CACHE_DIR", csv_path.parent / ".cache"))
+    path_key = hashlib.md5(str(csv_path).encode()).hexdigest()[:8]
+    prefix = "{}-{}-{}".format(csv_path.stem, path_key,
+                               "float64" if double else "float32")
+    cache = cache_dir / f"{prefix}-{os.stat(csv_path).st_mtime_ns}.npy"
+    if not cache.exists():
+        # the timestamp index is dropped, so it is not parsed as dates
+        dtype = np.float64 if double else np.float32
+        df = pd.read_csv(csv_path, index_col=0).to_numpy(dtype=dtype)
+        df = np.ascontiguousarray(df)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # write-then-rename so concurrent runs never read a partial file
+        tmp = cache.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, df)
+        os.replace(tmp, cache)
+        # copies of older versions of this csv are never read again
+        for stale in cache_dir.glob(f"{prefix}-*.npy"):
+            if stale != cache:
+                stale.unlink(missing_ok=True)
+    raw = torch.from_numpy(np.load(cache, mmap_mode="c"))
+    if storage_dtype is not None:
+        # cast the raw series, never the overlapping windows
+        raw = raw.to(storage_dtype)
+    num_steps, num_features = raw.shape
+    num_windows = (num_steps - window_width) // window_stride + 1
+    return raw.as_strided((num_windows, window_width, num_features),
+                          (window_stride * num_features, num_features, 1))
+
+
 # electricity load dataset
-def mfred(double=False, window_width=24 * 12 * 2):
-    df = pd.read_csv("../datasets/MFRED_wiztemp.csv",
-                     parse_dates=True,
-                     index_col=0).values
-    trajs = np.lib.stride_tricks.sliding_window_view(df, window_width, axis=0)
-    trajs = trajs.transpose(0, 2, 1)[::12]
+def mfred(double=False, window_width=24 * 12 * 2, storage_dtype=None):
+    trajs = load_trajs("../datasets/MFRED_wiztemp.csv",
+                       window_width,
+                       double,
+                       storage_dtype=storage_dtype)
 
     t = torch.arange(window_width)
     time = torch.diff(t).sum()
     sample_rate = window_width / time
     if double:
         t = t.double()
-        trajs = torch.from_numpy(trajs).double()
     else:
         t = t.float()
-        trajs = torch.from_numpy(trajs).float()
     features = {
         "hist_feature": [0],
         "fcst_feature": [0],
@@ -131,21 +237,22 @@ def mfred(double=False, window_width=24 * 12 * 2):
 
 
 # wind power dataset
-def nrel(double=False, window_width=24 * 12 * 2, transformed=False):
-    df = pd.read_csv("../datasets/nrel_all.csv", parse_dates=True,
-                     index_col=0).values
-    trajs = np.lib.stride_tricks.sliding_window_view(df, window_width, axis=0)
-    trajs = trajs.transpose(0, 2, 1)[::12]
+def nrel(double=False,
+         window_width=24 * 12 * 2,
+         transformed=False,
+         storage_dtype=None):
+    trajs = load_trajs("../datasets/nrel_all.csv",
+                       window_width,
+                       double,
+                       storage_dtype=storage_dtype)
 
     t = torch.arange(window_width)
     time = torch.diff(t).sum()
     sample_rate = window_width / time
     if double:
         t = t.double()
-        trajs = torch.from_numpy(trajs).double()
     else:
         t = t.float()
-        trajs = torch.from_numpy(trajs).float()
     features = {
         "hist_feature": [0],
         "fcst_feature": [0],
@@ -168,16 +275,10 @@ def sine(double=False, trajectories_to_sample=100, t_nsamples=200, num_pi=4):
     else:
         ti = torch.linspace(t_begin, t_end, t_nsamples)
 
-    def sampler(t, x0=0):
-        # return torch.sin(t + x0)
-        return torch.sin(t + x0) + torch.sin(
-            2 * (t + x0)) + 0.5 * torch.sin(12 * (t + x0))
-
     x0s = torch.linspace(0, 16 * torch.pi, trajectories_to_sample)
-    trajs = []
-    for x0 in x0s:
-        trajs.append(sampler(ti, x0))
-    y = torch.stack(trajs)
+    # all trajectories at once: (trajectories_to_sample, t_nsamples) phases
+    phase = ti.unsqueeze(0) + x0s.unsqueeze(1)
+    y = torch.sin(phase) + torch.sin(2 * phase) + 0.5 * torch.sin(12 * phase)
     trajectories = y.view(trajectories_to_sample, -1, 1)
     sample_rate = t_nsamples / ti.diff().sum() * 2 * np.pi
     print(sample_rate)
@@ -189,6 +290,28 @@ def sine(double=False, trajectories_to_sample=100, t_nsamples=200, num_pi=4):
     return trajectories, ti.unsqueeze(0), sample_rate, features
 
 
+def _dataset_generator(seed):
+    # missingness, noise and shuffling draw from this, not the global RNG
+    return torch.Generator().manual_seed(seed)
+
+
+def _nan_stats(trajectories):
+    # per-feature mean/std over all samples and steps, from one host copy;
+    # low-precision storage is reduced in float32
+    dtype = torch.promote_types(trajectories.dtype, torch.float32)
+    flat = trajectories.reshape(-1, trajectories.shape[-1]).to(dtype).numpy()
+    return (torch.from_numpy(np.nanmean(flat, axis=0)),
+            torch.from_numpy(np.nanstd(flat, axis=0)))
+
+
+def _normalize(trajectories, mean, std, inplace=False):
+    # one subtract and one in-place divide, broadcast over the feature dim;
+    # out of place by default since splits may view the memory-mapped windows
+    if inplace:
+        return trajectories.sub_(mean).div_(std)
+    return trajectories.sub(mean).div_(std)
+
+
 def generate_data_set(name,
                       device,
                       double=False,
@@ -207,21 +330,30 @@ def generate_data_set(name,
                       observe_steps=200,
                       seed=0,
                       avg_terms=1,
+                      preload=False,
+                      loader_kwargs=None,
+                      storage_dtype=None,
                       **kwargs):
     setup_seed(seed)
+    g = _dataset_generator(seed)
     if name == "nrel":
         trajectories, t, sample_rate, feature = nrel(
             double,
             transformed=kwargs.get("transformed"),
-            window_width=kwargs.get("window_width"))
+            window_width=kwargs.get("window_width"),
+            storage_dtype=storage_dtype)
     elif name == "sine":
         trajectories, t, sample_rate, feature = sine(double,
                                                      trajectories_to_sample,
                                                      t_nsamples)
+        if storage_dtype is not None:
+            trajectories = trajectories.to(storage_dtype)
 
     elif name == "mfred":
         trajectories, t, sample_rate, feature = mfred(
-            double, window_width=kwargs.get("window_width"))
+            double,
+            window_width=kwargs.get("window_width"),
+            storage_dtype=storage_dtype)
 
     else:
         raise ValueError("Unknown Dataset To Test")
@@ -229,17 +361,17 @@ def generate_data_set(name,
     if not add_external_feature:
         feature["avail_fcst_feature"] = None
 
-    if not extrap:
-        bool_mask = torch.FloatTensor(
-            *trajectories.shape).uniform_() < (1.0 - percent_missing_at_random)
-        if double:
-            float_mask = (bool_mask).double()
-        else:
-            float_mask = (bool_mask).float()
-        trajectories = float_mask * trajectories
+    if not extrap and percent_missing_at_random > 0:
+        draw = torch.rand(trajectories.shape,
+                          generator=g,
+                          dtype=trajectories.dtype)
+        trajectories = trajectories * (draw >= percent_missing_at_random)
 
     if noise_std:
-        trajectories += torch.randn(trajectories.shape) * noise_std
+        # out of place: the trajectories may be overlapping windows; the
+        # float32 noise would otherwise promote low-precision storage
+        noise = torch.randn(trajectories.shape, generator=g) * noise_std
+        trajectories = (trajectories + noise).to(trajectories.dtype)
 
     train_split = int(0.8 * trajectories.shape[0])
     test_split = int(0.9 * trajectories.shape[0])
@@ -247,76 +379,89 @@ def generate_data_set(name,
         train_trajectories = trajectories[:train_split, :, :]
         val_trajectories = trajectories[train_split:test_split, :, :]
         test_trajectories = trajectories[test_split:, :, :]
-        train_t = t
-        val_t = t
-        test_t = t
 
     else:
-        traj_index = torch.randperm(trajectories.shape[0])
-        train_trajectories = trajectories[traj_index[:train_split], :, :]
-        val_trajectories = trajectories[
-            traj_index[train_split:test_split], :, :]
-        test_trajectories = trajectories[traj_index[test_split:], :, :]
-        train_t = t
-        val_t = t
-        test_t = t
+        traj_index = torch.randperm(trajectories.shape[0], generator=g)
+        train_trajectories = trajectories.index_select(
+            0, traj_index[:train_split])
+        val_trajectories = trajectories.index_select(
+            0, traj_index[train_split:test_split])
+        test_trajectories = trajectories.index_select(
+            0, traj_index[test_split:])
+
+    rand_idx = torch.randperm(len(train_trajectories), generator=g)
+    train_trajectories = train_trajectories.index_select(0, rand_idx)
+    len_train, len_val = len(train_trajectories), len(val_trajectories)
+    # the splits are normalized and turned into one dataset together, then
+    # served as row ranges of it
+    trajectories = torch.cat(
+        [train_trajectories, val_trajectories, test_trajectories])
 
     if normalize:
-        len_train, len_val, len_test = len(train_trajectories), len(
-            val_trajectories), len(test_trajectories)
-        dim = trajectories.shape[2]
-        train_mean = torch.reshape(train_trajectories, (-1, dim)).cpu().numpy()
-        train_mean = torch.from_numpy(np.nanmean(train_mean, axis=0))
-        train_std = torch.reshape(train_trajectories, (-1, dim)).cpu().numpy()
-        train_std = torch.from_numpy(np.nanstd(train_std, axis=0))
-        train_trajectories = (torch.reshape(train_trajectories, (-1, dim)) -
-                              train_mean) / train_std
-        val_trajectories = (torch.reshape(val_trajectories,
-                                          (-1, dim)) - train_mean) / train_std
-        test_trajectories = (torch.reshape(test_trajectories,
-                                           (-1, dim)) - train_mean) / train_std
-        train_trajectories = train_trajectories.reshape((len_train, -1, dim))
-        val_trajectories = val_trajectories.reshape((len_val, -1, dim))
-        test_trajectories = test_trajectories.reshape((len_test, -1, dim))
+        # statistics from the training rows only
+        train_mean, train_std = _nan_stats(trajectories[:len_train])
+        _normalize(trajectories, train_mean, train_std, inplace=True)
     else:
         train_std = 1
         train_mean = 0
-    rand_idx = torch.randperm(len(train_trajectories)).tolist()
-    train_trajectories = train_trajectories[rand_idx]
-    dltrain = DataLoader(TimeSeriesDataset(train_trajectories, train_t,
-                                           observe_steps, avg_terms,
-                                           **feature),
-                         batch_size=batch_size,
-                         shuffle=False,
-                         collate_fn=collate_fn)
-    dlval = DataLoader(TimeSeriesDataset(val_trajectories, val_t,
-                                         observe_steps, avg_terms, **feature),
-                       batch_size=batch_size,
-                       shuffle=False,
-                       collate_fn=collate_fn)
-    dltest = DataLoader(TimeSeriesDataset(test_trajectories, test_t,
-                                          observe_steps, avg_terms, **feature),
-                        batch_size=batch_size,
-                        shuffle=False,
-                        collate_fn=collate_fn)
-
-    b = next(iter(dltrain))
-    if b["available_forecasts"] is not None:
-        input_dim = (b["observed_data"].shape[-1],
-                     b["available_forecasts"].shape[-1])
-        avail_fcst_timesteps = b["available_forecasts"].shape[1]
+    ds = TimeSeriesDataset(trajectories,
+                           t,
+                           observe_steps,
+                           avg_terms,
+                           avail_fcst_stride=avail_fcst_stride,
+                           **feature)
+    if preload:
+        # the datasets are small enough to live on the device for the whole
+        # run, so batches come out of the loader without host-to-device copies
+        ds.to(device)
+    ds_train = ds.subset(0, len_train)
+    ds_val = ds.subset(len_train, len_train + len_val)
+    ds_test = ds.subset(len_train + len_val, len(ds))
+    if loader_kwargs is None:
+        # preloaded tensors are already on the device: nothing to pin, and
+        # worker processes must not touch CUDA tensors
+        if preload:
+            train_kwargs, eval_kwargs = {}, {}
+        else:
+            train_kwargs, eval_kwargs = default_loader_kwargs(device)
+    else:
+        train_kwargs = eval_kwargs = loader_kwargs
+    dtype = torch.float64 if double else torch.float32
+    dltrain = make_dataloader(ds_train, batch_size, dtype, **train_kwargs)
+    dlval = make_dataloader(ds_val, batch_size, dtype, **eval_kwargs)
+    dltest = make_dataloader(ds_test, batch_size, dtype, **eval_kwargs)
+
+    if ds.avail_fcst:
+        input_dim = (ds.observed_data.shape[-1],
+                     ds.available_forecasts.shape[-1])
+        avail_fcst_timesteps = ds.available_forecasts.shape[1]
     else:
-        input_dim = (b["observed_data"].shape[-1], None)
+        input_dim = (ds.observed_data.shape[-1], None)
         avail_fcst_timesteps = None
 
-    output_dim = b["data_to_predict"].shape[-1]
-    input_timesteps = (b["observed_data"].shape[1], avail_fcst_timesteps)
-    output_timesteps = b["data_to_predict"].shape[1]
+    output_dim = ds.data_to_predict.shape[-1]
+    input_timesteps = (ds.observed_data.shape[1], avail_fcst_timesteps)
+    output_timesteps = ds.data_to_predict.shape[1]
 
     return (input_dim, output_dim, sample_rate, t, dltrain, dlval, dltest,
             input_timesteps, output_timesteps, train_mean, train_std, feature)
 
 
+def _np(t):
+    # (N, ...) tensor as an (N, -1) numpy array, sharing memory when contiguous
+    return t.detach().numpy().reshape(t.shape[0], -1)
+
+
+def _tree_arrays(ds):
+    # flattened history followed by the flattened available forecasts,
+    # written into a single preallocated feature matrix
+    observed, forecasts = _np(ds.observed_data), _np(ds.available_forecasts)
+    x = np.empty((len(ds), observed.shape[1] + forecasts.shape[1]),
+                 dtype=np.result_type(observed, forecasts))
+    np.concatenate([observed, forecasts], axis=1, out=x)
+    return x, _np(ds.data_to_predict)
+
+
 def generate_tree_data_set(
     name,
     device,
@@ -338,7 +483,10 @@ def generate_tree_data_set(
     avg_terms=1,
     **kwargs,
 ):
+    if kwargs.get("storage_dtype") is not None:
+        raise ValueError("storage_dtype is not supported for tree models")
     setup_seed(seed)
+    g = _dataset_generator(seed)
     if name == "nrel":
         trajectories, t, sample_rate, feature = nrel(
             double,
@@ -360,17 +508,15 @@ def generate_tree_data_set(
     if not add_external_feature:
         feature["avail_fcst_feature"] = None
 
-    if not extrap:
-        bool_mask = torch.FloatTensor(
-            *trajectories.shape).uniform_() < (1.0 - percent_missing_at_random)
-        if double:
-            float_mask = (bool_mask).double()
-        else:
-            float_mask = (bool_mask).float()
-        trajectories = float_mask * trajectories
+    if not extrap and percent_missing_at_random > 0:
+        draw = torch.rand(trajectories.shape,
+                          generator=g,
+                          dtype=trajectories.dtype)
+        trajectories = trajectories * (draw >= percent_missing_at_random)
 
     if noise_std:
-        trajectories += torch.randn(trajectories.shape) * noise_std
+        trajectories = trajectories + torch.randn(
+            trajectories.shape, generator=g) * noise_std
 
     train_split = int(0.8 * trajectories.shape[0])
     test_split = int(0.9 * trajectories.shape[0])
@@ -388,11 +534,13 @@ def generate_tree_data_set(
             test_t = t
 
     else:
-        traj_index = torch.randperm(trajectories.shape[0])
-        train_trajectories = trajectories[traj_index[:train_split], :, :]
-        val_trajectories = trajectories[
-            traj_index[train_split:test_split], :, :]
-        test_trajectories = trajectories[traj_index[test_split:], :, :]
+        traj_index = torch.randperm(trajectories.shape[0], generator=g)
+        train_trajectories = trajectories.index_select(
+            0, traj_index[:train_split])
+        val_trajectories = trajectories.index_select(
+            0, traj_index[train_split:test_split])
+        test_trajectories = trajectories.index_select(
+            0, traj_index[test_split:])
         if name.__contains__("time"):
             train_t = t[traj_index[:train_split]]
             val_t = t[traj_index[train_split:test_split]]
@@ -403,84 +551,33 @@ def generate_tree_data_set(
             test_t = t
 
     if normalize:
-        len_train, len_val, len_test = (
-            len(train_trajectories),
-            len(val_trajectories),
-            len(test_trajectories),
-        )
-        dim = trajectories.shape[2]
-        train_mean = torch.reshape(train_trajectories, (-1, dim)).cpu().numpy()
-        train_mean = torch.from_numpy(np.nanmean(train_mean, axis=0))
-        train_std = torch.reshape(train_trajectories, (-1, dim)).cpu().numpy()
-        train_std = torch.from_numpy(np.nanstd(train_std, axis=0))
-        train_trajectories = (torch.reshape(train_trajectories, (-1, dim)) -
-                              train_mean) / train_std
-        val_trajectories = (torch.reshape(val_trajectories,
-                                          (-1, dim)) - train_mean) / train_std
-        test_trajectories = (torch.reshape(test_trajectories,
-                                           (-1, dim)) - train_mean) / train_std
-        train_trajectories = train_trajectories.reshape((len_train, -1, dim))
-        val_trajectories = val_trajectories.reshape((len_val, -1, dim))
-        test_trajectories = test_trajectories.reshape((len_test, -1, dim))
+        train_mean, train_std = _nan_stats(train_trajectories)
+        train_trajectories = _normalize(train_trajectories, train_mean,
+                                        train_std)
+        val_trajectories = _normalize(val_trajectories, train_mean, train_std)
+        test_trajectories = _normalize(test_trajectories, train_mean,
+                                       train_std)
     else:
         train_std = 1
         train_mean = 0
-    rand_idx = torch.randperm(len(train_trajectories)).tolist()
-    train_trajectories = train_trajectories[rand_idx]
+    rand_idx = torch.randperm(len(train_trajectories), generator=g)
+    train_trajectories = train_trajectories.index_select(0, rand_idx)
 
-    dltrain = DataLoader(
+    # every split is used whole, so the arrays come straight from the
+    # dataset tensors without going through a loader
+    x_train, y_train = _tree_arrays(
         TimeSeriesDataset(train_trajectories, train_t, observe_steps,
-                          avg_terms, **feature),
-        batch_size=len(train_trajectories),
-        shuffle=False,
-        collate_fn=collate_fn,
-    )
-    dlval = DataLoader(
+                          avg_terms, avail_fcst_stride=avail_fcst_stride,
+                          **feature))
+    x_val, y_val = _tree_arrays(
         TimeSeriesDataset(val_trajectories, val_t, observe_steps, avg_terms,
-                          **feature),
-        batch_size=len(train_trajectories),
-        shuffle=False,
-        collate_fn=collate_fn,
-    )
-    dltest = DataLoader(
+                          avail_fcst_stride=avail_fcst_stride, **feature))
+    x_test, y_test = _tree_arrays(
         TimeSeriesDataset(test_trajectories, test_t, observe_steps, avg_terms,
-                          **feature),
-        batch_size=len(train_trajectories),
-        shuffle=False,
-        collate_fn=collate_fn,
-    )
-
-    train_data = next(iter(dltrain))
-    val_data = next(iter(dlval))
-    test_data = next(iter(dltest))
-
-    x_train = torch.concat(
-        [
-            train_data["observed_data"].flatten(1),
-            train_data["available_forecasts"].flatten(1),
-        ],
-        dim=-1,
-    )
-    y_train = train_data["data_to_predict"].flatten(1)
-    x_val = torch.concat(
-        [
-            val_data["observed_data"].flatten(1),
-            val_data["available_forecasts"].flatten(1),
-        ],
-        dim=-1,
-    )
-    y_val = val_data["data_to_predict"].flatten(1)
-    x_test = torch.concat(
-        [
-            test_data["observed_data"].flatten(1),
-            test_data["available_forecasts"].flatten(1),
-        ],
-        dim=-1,
-    )
-    y_test = test_data["data_to_predict"].flatten(1)
-    dltrain = (x_train.cpu().numpy(), y_train.cpu().numpy())
-    dlval = (x_val.cpu().numpy(), y_val.cpu().numpy())
-    dltest = (x_test.cpu().numpy(), y_test.cpu().numpy())
+                          avail_fcst_stride=avail_fcst_stride, **feature))
+    dltrain = (x_train, y_train)
+    dlval = (x_val, y_val)
+    dltest = (x_test, y_test)
 
     input_dim = x_train.shape[-1]
     output_dim = y_train.shape[-1]
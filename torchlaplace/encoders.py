@@ -128,8 +128,9 @@ class GRUEncoder(nn.Module):
                         observed_data.shape[0], 1, 1)),
                     dim=2)
         reversed_trajs_to_encode = trajs_to_encode
-        out, _ = self.gru(reversed_trajs_to_encode)
-        return self.linear_out(out[:, -1, :])
+        # h_n[-1] is the last layer's final hidden state, i.e. out[:, -1, :]
+        _, h_n = self.gru(reversed_trajs_to_encode)
+        return self.linear_out(h_n[-1])
 
 
 
@@ -5,6 +5,7 @@ from torch import nn
 from .core import laplace_reconstruct
 import torchlaplace.inverse_laplace
 from .encoders import BiEncoder
+from .utils import collect_predictions
 
 logger = logging.getLogger()
 
@@ -60,11 +61,11 @@ class SphereSurfaceModel(nn.Module):
         # If include_s_recon_terms: inputs shape: [batchsize, 2 * s_dim + latent_dim]
         # else                      inputs shape: [batchsize, s_dim, 2 + latent_dim]
         self.nfe += 1
-        out = self.linear_tanh_stack(i.view(-1, self.dim_in))
+        # one tanh over the whole output instead of one per angle
+        out = torch.tanh(self.linear_tanh_stack(i.view(-1, self.dim_in)))
 
-        theta = nn.Tanh()(
-            out[..., :self.divide_point]) * torch.pi  # From - pi to + pi
-        phi = (nn.Tanh()(out[..., self.divide_point:]) * self.phi_scale / 2.0 -
+        theta = out[..., :self.divide_point] * torch.pi  # From - pi to + pi
+        phi = (out[..., self.divide_point:] * self.phi_scale / 2.0 -
                torch.pi / 2.0 + self.phi_scale / 2.0
                )  # Form -pi / 2 to + pi / 2
         theta = theta.view(i.shape[0], 1, -1)
@@ -214,18 +215,38 @@ class HierarchicalNeuralLaplace(nn.Module):
 
         torchlaplace.inverse_laplace.device = device
 
+        # (tp_to_predict, averaged tp per resolution) of the last time grid
+        self._tp_cache = (None, None)
+
+    def _avg_tp_to_predict(self, tp_to_predict):
+        # every batch of a dataset shares the same time grid, so the averaged
+        # output timesteps are only recomputed when a new grid comes in;
+        # loader workers hand over a fresh copy per batch, hence the value check
+        cached = self._tp_cache[0]
+        if not (cached is tp_to_predict or
+                (cached is not None and cached.shape == tp_to_predict.shape
+                 and cached.dtype == tp_to_predict.dtype
+                 and cached.device == tp_to_predict.device
+                 and torch.equal(cached, tp_to_predict))):
+            avg_tps = []
+            for avg_terms in self.avg_terms_list:
+                # avg the output timesteps
+                avg_tp_to_predict = tp_to_predict[..., None].transpose(1, 2)
+                avg_tp_to_predict = torch.nn.functional.avg_pool1d(
+                    avg_tp_to_predict, avg_terms, avg_terms)
+                avg_tps.append(
+                    avg_tp_to_predict.transpose(1, 2).squeeze().unsqueeze(0))
+            self._tp_cache = (tp_to_predict, avg_tps)
+        return self._tp_cache[1]
 
     def forward(self, observed_data, available_forecasts, observed_tp,
                 tp_to_predict):
         all_fcsts, all_recons = [], []
+        avg_tps = self._avg_tp_to_predict(tp_to_predict)
         for i in range(len(self.avg_terms_list)):
-            # avg the output timesteps
-            avg_tp_to_predict = tp_to_predict[..., None].transpose(1, 2)
-            avg_tp_to_predict = torch.nn.functional.avg_pool1d(
-                avg_tp_to_predict, self.avg_terms_list[i],
-                self.avg_terms_list[i])
-            avg_tp_to_predict = avg_tp_to_predict.transpose(
-                1, 2).squeeze().unsqueeze(0)
+            avg_tp_to_predict = avg_tps[i]
+            if not self.pass_raw:
+                all_tp = torch.cat([observed_tp, avg_tp_to_predict], axis=-1)
 
             out = observed_data
             fcsts, recons = 0, 0
@@ -249,8 +270,6 @@ class HierarchicalNeuralLaplace(nn.Module):
                         options={"start_k": self.start_ks[j]})
                     fcsts += fcst
                 else:
-                    all_tp = torch.cat([observed_tp, avg_tp_to_predict],
-                                       axis=-1)
                     p = encoder(out, available_forecasts, observed_tp)
                     temp = laplace_reconstruct(
                         nlblk,
@@ -281,15 +300,12 @@ class HierarchicalNeuralLaplace(nn.Module):
                 tp_to_predict):
         self.eval()
         all_fcsts, all_recons = [], []
+        avg_tps = self._avg_tp_to_predict(tp_to_predict)
 
         for i in range(len(self.avg_terms_list)):
-            # avg the output timesteps
-            avg_tp_to_predict = tp_to_predict[..., None].transpose(1, 2)
-            avg_tp_to_predict = torch.nn.functional.avg_pool1d(
-                avg_tp_to_predict, self.avg_terms_list[i],
-                self.avg_terms_list[i])
-            avg_tp_to_predict = avg_tp_to_predict.transpose(
-                1, 2).squeeze().unsqueeze(0)
+            avg_tp_to_predict = avg_tps[i]
+            if not self.pass_raw:
+                all_tp = torch.cat([observed_tp, avg_tp_to_predict], axis=-1)
 
             out = observed_data
             fcsts, recons = 0, 0
@@ -313,8 +329,6 @@ class HierarchicalNeuralLaplace(nn.Module):
                         options={"start_k": self.start_ks[j]})
                     fcsts += fcst
                 else:
-                    all_tp = torch.cat([observed_tp, avg_tp_to_predict],
-                                       axis=-1)
                     p = encoder(out, available_forecasts, observed_tp)
                     temp = laplace_reconstruct(
                         nlblk,
@@ -343,15 +357,12 @@ class HierarchicalNeuralLaplace(nn.Module):
                           observed_tp, tp_to_predict):
         self.eval()
         all_fcsts, all_recons = [], []
+        avg_tps = self._avg_tp_to_predict(tp_to_predict)
 
         for i in range(len(self.avg_terms_list)):
-            # avg the output timesteps
-            avg_tp_to_predict = tp_to_predict[..., None].transpose(1, 2)
-            avg_tp_to_predict = torch.nn.functional.avg_pool1d(
-                avg_tp_to_predict, self.avg_terms_list[i],
-                self.avg_terms_list[i])
-            avg_tp_to_predict = avg_tp_to_predict.transpose(
-                1, 2).squeeze().unsqueeze(0)
+            avg_tp_to_predict = avg_tps[i]
+            if not self.pass_raw:
+                all_tp = torch.cat([observed_tp, avg_tp_to_predict], axis=-1)
 
             out = observed_data
             fcsts, recons = [], []
@@ -375,8 +386,6 @@ class HierarchicalNeuralLaplace(nn.Module):
                         options={"start_k": self.start_ks[j]})
                     fcsts.append(fcst.cpu().numpy())
                 else:
-                    all_tp = torch.cat([observed_tp, avg_tp_to_predict],
-                                       axis=-1)
                     p = encoder(out, available_forecasts, observed_tp)
                     temp = laplace_reconstruct(
                         nlblk,
@@ -443,27 +452,27 @@ class GeneralHNL(nn.Module):
         self.avg_terms_list = avg_terms_list
         self.loss_fn = torch.nn.MSELoss()
 
+    @torch.no_grad()
     def _get_loss(self, dl):
-        cum_loss = 0
-        cum_samples = 0
+        # summed squared error and element count per resolution
+        cum_loss = [0] * len(self.avg_terms_list)
+        cum_numel = [0] * len(self.avg_terms_list)
         for batch in dl:
             preds = self.model(batch["observed_data"],
                                batch["available_forecasts"],
                                batch["observed_tp"], batch["tp_to_predict"])
-            loss = 0
             for i, avg_terms in enumerate(self.avg_terms_list):
                 data_to_predict = batch["data_to_predict"].transpose(1, 2)
                 data_to_predict = torch.nn.functional.avg_pool1d(
                     data_to_predict, avg_terms, avg_terms)
                 data_to_predict = data_to_predict.transpose(1, 2)
-                resolution_loss = self.loss_fn(torch.flatten(preds[i]),
-                                               torch.flatten(data_to_predict))
-                loss += resolution_loss
-            loss /= len(self.avg_terms_list)
-            # cum_loss += recon_loss
-            cum_loss += loss * batch["observed_data"].shape[0]
-            cum_samples += batch["observed_data"].shape[0]
-        mse = cum_loss / cum_samples
+                cum_loss[i] += torch.nn.functional.mse_loss(
+                    torch.flatten(preds[i]),
+                    torch.flatten(data_to_predict),
+                    reduction="sum")
+                cum_numel[i] += preds[i].numel()
+        mse = sum(loss / numel for loss, numel in zip(cum_loss, cum_numel))
+        mse /= len(self.avg_terms_list)
         return mse
 
     def training_step(self, batch):
@@ -497,18 +506,13 @@ class GeneralHNL(nn.Module):
     @torch.no_grad()
     def predict(self, dl):
         self.model.eval()
-        predictions, trajs = [], []
-        for batch in dl:
-            preds, _ = self.model.predict(batch["observed_data"],
-                                          batch["available_forecasts"],
-                                          batch["observed_tp"],
-                                          batch["tp_to_predict"])
-            predictions.append(preds)
-            trajs.append(batch["data_to_predict"])
-
-        out_preds = [torch.concat(f) for f in zip(*predictions)]
-
-        return out_preds, torch.cat(trajs, 0)
+        # one buffer per resolution, filled batch by batch
+        return collect_predictions(
+            ((self.model.predict(batch["observed_data"],
+                                 batch["available_forecasts"],
+                                 batch["observed_tp"],
+                                 batch["tp_to_predict"])[0],
+              batch["data_to_predict"]) for batch in dl), len(dl.dataset))
 
 
 
@@ -550,18 +554,18 @@ class GeneralNeuralLaplace(nn.Module):
 
     def _get_loss(self, dl):
         cum_loss = 0
-        cum_samples = 0
+        cum_numel = 0
         for batch in dl:
             preds = self.model(batch["observed_data"],
                                 batch["available_forecasts"],
                                 batch["observed_tp"],
                                 batch["tp_to_predict"])
-            
-            cum_loss += self.loss_fn(torch.flatten(preds),
-                                     torch.flatten(batch["data_to_predict"])
-                                     ) * batch["observed_data"].shape[0]
-            cum_samples += batch["observed_data"].shape[0]
-        mse = cum_loss / cum_samples
+
+            cum_loss += torch.nn.functional.mse_loss(preds,
+                                                     batch["data_to_predict"],
+                                                     reduction="sum")
+            cum_numel += preds.numel()
+        mse = cum_loss / cum_numel
         return mse
 
     def training_step(self, batch):
@@ -590,17 +594,10 @@ class GeneralNeuralLaplace(nn.Module):
     @torch.no_grad()
     def predict(self, dl):
         self.model.eval()
-        predictions, trajs = [], []
-        for batch in dl:
-            preds = self.model(batch["observed_data"],
-                                batch["available_forecasts"],
-                                batch["observed_tp"],
-                                batch["tp_to_predict"])
-           
-            predictions.append(preds)
-            trajs.append(batch["data_to_predict"])
-
-        out_preds = torch.cat(predictions, 0)
-        
-        return out_preds, torch.cat(trajs, 0)
+        return collect_predictions(
+            ((self.model(batch["observed_data"],
+                         batch["available_forecasts"],
+                         batch["observed_tp"],
+                         batch["tp_to_predict"]),
+              batch["data_to_predict"]) for batch in dl), len(dl.dataset))
 
@@ -31,6 +31,12 @@ def train_and_test(
     val_losses = []
     train_nfes = []
     epoch_num = []
+    # bf16 keeps the fp32 exponent range, so no GradScaler is needed; float64
+    # models are left untouched by autocast
+    device_type = torch.device(device).type
+    amp_dtype = torch.float16
+    if device_type == "cuda" and torch.cuda.is_bf16_supported():
+        amp_dtype = torch.bfloat16
     for epoch in range(epochs):
         iteration = 0
         epoch_train_loss_it_cum = 0
@@ -43,7 +49,9 @@ def train_and_test(
             optim.zero_grad()
             
             # ! FOR NBEATX, TFT, DLINEAR, USE AMP
-            with torch.cuda.amp.autocast():
+            with torch.autocast(device_type=device_type,
+                                dtype=amp_dtype,
+                                enabled=device_type == "cuda"):
                 train_loss = system.training_step(batch)
 
             # ! OTHERS NO AMP
@@ -108,6 +116,28 @@ def train_and_test(
     )
 
 
+def collect_predictions(outputs, num_samples):
+    # write each (preds, trajs) batch into buffers sized for the whole dataset
+    # instead of concatenating a list of chunks, which doubles peak memory;
+    # preds may also be a list holding one tensor per resolution
+    offset = 0
+    for preds, trajs in outputs:
+        is_list = isinstance(preds, (list, tuple))
+        chunks = preds if is_list else [preds]
+        if offset == 0:
+            predictions = [
+                chunk.new_empty((num_samples, ) + chunk.shape[1:])
+                for chunk in chunks
+            ]
+            targets = trajs.new_empty((num_samples, ) + trajs.shape[1:])
+        size = trajs.shape[0]
+        for buffer, chunk in zip(predictions, chunks):
+            buffer[offset:offset + size] = chunk
+        targets[offset:offset + size] = trajs
+        offset += size
+    return (predictions if is_list else predictions[0]), targets
+
+
 def setup_seed(seed: int = 9):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
@@ -118,17 +148,22 @@ def setup_seed(seed: int = 9):
 
 
 def init_weights(m, seed):
+    # each randomly initialised module still starts from a freshly seeded
+    # generator; only torch's RNG is reseeded, and only where it is drawn from
+    setup_seed(seed)
     for m in m.modules():
-        setup_seed(seed)
         if isinstance(m, nn.BatchNorm1d):
             m.reset_parameters()
 
         elif isinstance(m, nn.Linear):
+            torch.manual_seed(seed)
             nn.init.xavier_uniform_(m.weight)
             nn.init.constant_(m.bias, 0.01)
         elif isinstance(m, (nn.Conv1d, nn.Conv2d, nn.Conv3d)):
+            torch.manual_seed(seed)
             m.reset_parameters()
         elif isinstance(m, (nn.GRU, nn.LSTM, nn.RNN)):
+            torch.manual_seed(seed)
             for name, param in m.named_parameters():
                 if 'weight_ih' in name:
                     torch.nn.init.xavier_uniform_(param.data)